@@ -4,8 +4,9 @@
 # Distributed under Gnu LGPL 3.0
 # see http://www.gnu.org/licenses/lgpl-3.0.txt
 
-import sys, struct, zlib, os
-import binascii
+import sys, struct, zlib, os, mmap
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from optparse import OptionParser
 
 try:
@@ -20,121 +21,160 @@ DEFAULT_NAME = b"ST..."
 PREFIX_SIZE = 11
 SUFFIX_SIZE = 16
 
+CRC_CHUNK_SIZE = 1 << 20
 
-def named(tuple, names):
-    return dict(list(zip(names.split(), tuple)))
+_PREFIX = struct.Struct("<5sBIB")
+_TPREFIX = struct.Struct("<6sBI255s2I")
+_ELEM = struct.Struct("<2I")
+_SUFFIX = struct.Struct("<4H3sBI")
+_SUFFIX_OUT = struct.Struct("<4H3sB")
 
+Prefix = namedtuple("Prefix", "signature version size targets")
+TargetPrefix = namedtuple(
+    "TargetPrefix", "signature altsetting named name size elements"
+)
+Suffix = namedtuple("Suffix", "device product vendor dfu ufd len crc")
 
-def consume(fmt, data, names):
-    n = struct.calcsize(fmt)
-    return named(struct.unpack(fmt, data[:n]), names), data[n:]
+# S-record data types mapped to the width of their address field in bytes
+S19_DATA_RECORDS = {b"S1": 2, b"S2": 3, b"S3": 4}
+
+
+def consume(fmt, record, data, offset=0):
+    return record._make(fmt.unpack_from(data, offset)), offset + fmt.size
 
 
 def cstring(bytestring):
     return bytestring.partition(b"\0")[0]
 
 
+def mapfile(f):
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def compute_crc(data):
-    return 0xFFFFFFFF & -zlib.crc32(data) - 1
+    # Feed zlib in chunks so large mapped files are walked piecewise
+    view = memoryview(data)
+    crc = 0
+    for off in range(0, len(view), CRC_CHUNK_SIZE):
+        crc = zlib.crc32(view[off : off + CRC_CHUNK_SIZE], crc)
+    return ~crc & 0xFFFFFFFF
 
 
 def parse(file, dump_images=False):
     print('File: "%s"' % file)
-    data = open(file, "rb").read()
-    crc = compute_crc(data[:-4])
-    prefix, data = consume("<5sBIB", data, "signature version size targets")
-    print(
-        "%(signature)s v%(version)d, image size: %(size)d, targets: %(targets)d"
-        % prefix
-    )
-    for t in range(prefix["targets"]):
-        tprefix, data = consume(
-            "<6sBI255s2I", data, "signature altsetting named name size elements"
+    # Targets and images are sliced as views of the mapping, so nothing is
+    # copied unless it gets dumped
+    with open(file, "rb") as f, mapfile(f) as data, memoryview(data) as view:
+        prefix, off = consume(_PREFIX, Prefix, data)
+        print(
+            f"{prefix.signature} v{prefix.version}, image size: {prefix.size}, targets: {prefix.targets}"
         )
-        tprefix["num"] = t
-        if tprefix["named"]:
-            tprefix["name"] = cstring(tprefix["name"])
-        else:
-            tprefix["name"] = ""
+        if prefix.size != len(data):
+            print(
+                "PARSE ERROR: image size %d does not match file size %d"
+                % (prefix.size, len(data))
+            )
+            return
+        for t in range(prefix.targets):
+            tprefix, off = consume(_TPREFIX, TargetPrefix, data, off)
+            tname = cstring(tprefix.name) if tprefix.named else ""
+            print(
+                f'{tprefix.signature} {t}, alt setting: {tprefix.altsetting}, name: "{tname}", size: {tprefix.size}, elements: {tprefix.elements}'
+            )
+            tsize = tprefix.size
+            with view[off : off + tsize] as target:
+                eoff = 0
+                for e in range(tprefix.elements):
+                    address, esize = _ELEM.unpack_from(target, eoff)
+                    eoff += _ELEM.size
+                    print(f"  {e}, address: 0x{address:08x}, size: {esize}")
+                    if dump_images:
+                        out = "%s.target%d.image%d.bin" % (file, t, e)
+                        open(out, "wb").write(target[eoff : eoff + esize])
+                        print('    DUMPED IMAGE TO "%s"' % out)
+                    eoff += esize
+                if eoff != len(target):
+                    print("target %d: PARSE ERROR" % t)
+            off += tsize
+        if off != len(data) - SUFFIX_SIZE:
+            print("PARSE ERROR")
+        suffix, _ = consume(_SUFFIX, Suffix, data, len(data) - SUFFIX_SIZE)
         print(
-            '%(signature)s %(num)d, alt setting: %(altsetting)s, name: "%(name)s", size: %(size)d, elements: %(elements)d'
-            % tprefix
+            f"usb: {suffix.vendor:04x}:{suffix.product:04x}, device: 0x{suffix.device:04x}, dfu: 0x{suffix.dfu:04x}, {suffix.ufd}, {suffix.len}, 0x{suffix.crc:08x}"
         )
-        tsize = tprefix["size"]
-        target, data = data[:tsize], data[tsize:]
-        for e in range(tprefix["elements"]):
-            eprefix, target = consume("<2I", target, "address size")
-            eprefix["num"] = e
-            print("  %(num)d, address: 0x%(address)08x, size: %(size)d" % eprefix)
-            esize = eprefix["size"]
-            image, target = target[:esize], target[esize:]
-            if dump_images:
-                out = "%s.target%d.image%d.bin" % (file, t, e)
-                open(out, "wb").write(image)
-                print('    DUMPED IMAGE TO "%s"' % out)
-        if len(target):
-            print("target %d: PARSE ERROR" % t)
-    suffix = named(
-        struct.unpack("<4H3sBI", data[:SUFFIX_SIZE]),
-        "device product vendor dfu ufd len crc",
-    )
-    print(
-        "usb: %(vendor)04x:%(product)04x, device: 0x%(device)04x, dfu: 0x%(dfu)04x, %(ufd)s, %(len)d, 0x%(crc)08x"
-        % suffix
-    )
-    if crc != suffix["crc"]:
-        print("CRC ERROR: computed crc32 is 0x%08x" % crc)
-    data = data[SUFFIX_SIZE:]
-    if data:
-        print("PARSE ERROR")
+        crc = compute_crc(view[:-4])
+        if crc != suffix.crc:
+            print("CRC ERROR: computed crc32 is 0x%08x" % crc)
 
 
-def checkbin(binfile):
-    data = open(binfile, "rb").read()
+def checkbin(binfile, data):
     if len(data) < SUFFIX_SIZE:
         return
-    crc = compute_crc(data[:-4])
-    suffix = named(
-        struct.unpack("<4H3sBI", data[-SUFFIX_SIZE:]),
-        "device product vendor dfu ufd len crc",
-    )
-    if crc == suffix["crc"] and suffix["ufd"] == b"UFD":
+    suffix, _ = consume(_SUFFIX, Suffix, data, len(data) - SUFFIX_SIZE)
+    # Only walk the whole file for the CRC if the suffix marker is there
+    if suffix.ufd != b"UFD":
+        return
+    crc = compute_crc(memoryview(data)[:-4])
+    if crc == suffix.crc:
         print(
-            "usb: %(vendor)04x:%(product)04x, device: 0x%(device)04x, dfu: 0x%(dfu)04x, %(ufd)s, %(len)d, 0x%(crc)08x"
-            % suffix
+            f"usb: {suffix.vendor:04x}:{suffix.product:04x}, device: 0x{suffix.device:04x}, dfu: 0x{suffix.dfu:04x}, {suffix.ufd}, {suffix.len}, 0x{suffix.crc:08x}"
         )
         print("It looks like the file %s has a DFU suffix!" % binfile)
         print("Please remove any DFU suffix and retry.")
         sys.exit(1)
 
 
+def hexsegments(hexfile):
+    ih = IntelHex(hexfile)
+    return [
+        (address & 0xFFFFFFFF, ih.tobinstr(start=address, end=end - 1))
+        for address, end in ih.segments()
+    ]
+
+
+def coalesce(segments):
+    # Merge (address, data) segments that directly follow one another, e.g.
+    # where one hex file picks up exactly where the previous one ended
+    runs = []
+    for address, data in segments:
+        if runs and runs[-1][0] + runs[-1][1] == address:
+            runs[-1][1] += len(data)
+            runs[-1][2].append(data)
+        else:
+            runs.append([address, len(data), [data]])
+    return [(address, b"".join(chunks)) for address, _, chunks in runs]
+
+
 def build(file, targets, name=DEFAULT_NAME, device=DEFAULT_DEVICE):
-    data = b""
+    # Headers are packed into reserved slots once their sizes are known
+    data = bytearray(PREFIX_SIZE)
+    extend = data.extend
+    pack_elem = _ELEM.pack
     for t, target in enumerate(targets):
-        tdata = b""
+        toff = len(data)
+        extend(bytes(_TPREFIX.size))
         for image in target:
-            tdata += (
-                struct.pack("<2I", image["address"], len(image["data"])) + image["data"]
-            )
+            image_data = image["data"]
+            extend(pack_elem(image["address"], len(image_data)))
+            extend(image_data)
             ealt = image["alt"]
-        tdata = (
-            struct.pack(
-                "<6sBI255s2I", b"Target", ealt, 1, name, len(tdata), len(target)
-            )
-            + tdata
-        )
-        data += tdata
-    data = (
-        struct.pack(
-            "<5sBIB", b"DfuSe", 1, PREFIX_SIZE + len(data) + SUFFIX_SIZE, len(targets)
-        )
-        + data
-    )
+        tsize = len(data) - toff - _TPREFIX.size
+        _TPREFIX.pack_into(data, toff, b"Target", ealt, 1, name, tsize, len(target))
+    data.extend(bytes(SUFFIX_SIZE))
+    _PREFIX.pack_into(data, 0, b"DfuSe", 1, len(data), len(targets))
     v, d = [int(x, 0) & 0xFFFF for x in device.split(":", 1)]
-    data += struct.pack("<4H3sB", 0, d, v, 0x011A, b"UFD", SUFFIX_SIZE)
-    crc = compute_crc(data)
-    data += struct.pack("<I", crc)
-    open(file, "wb").write(data)
+    soff = len(data) - SUFFIX_SIZE
+    _SUFFIX_OUT.pack_into(data, soff, 0, d, v, 0x011A, b"UFD", SUFFIX_SIZE)
+    crc = compute_crc(memoryview(data)[:-4])
+    struct.pack_into("<I", data, soff + _SUFFIX_OUT.size, crc)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(file, flags, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
 
 
 if __name__ == "__main__":
@@ -236,7 +276,9 @@ if __name__ == "__main__":
                 if not os.path.isfile(binfile):
                     print("Unreadable file '%s'." % binfile)
                     sys.exit(1)
-                checkbin(binfile)
+                with open(binfile, "rb") as f:
+                    bindata = f.read()
+                checkbin(binfile, bindata)
                 if old_ealt is not None and ealt != old_ealt:
                     targets.append(target)
                     target = []
@@ -244,7 +286,7 @@ if __name__ == "__main__":
                     {
                         "address": address,
                         "alt": ealt,
-                        "data": open(binfile, "rb").read(),
+                        "data": bindata,
                     }
                 )
                 old_ealt = ealt
@@ -254,21 +296,17 @@ if __name__ == "__main__":
             if not IntelHex:
                 print("Error: IntelHex python module could not be found")
                 sys.exit(1)
-            for hexf in options.hexfiles:
-                ih = IntelHex(hexf)
-                for address, end in ih.segments():
-                    try:
-                        address = address & 0xFFFFFFFF
-                    except ValueError:
-                        print("Address %s invalid." % address)
-                        sys.exit(1)
-                    target.append(
-                        {
-                            "address": address,
-                            "alt": default_alt,
-                            "data": ih.tobinstr(start=address, end=end - 1),
-                        }
-                    )
+            # Each hex file is parsed independently, so spread them over workers
+            if len(options.hexfiles) > 1:
+                with ProcessPoolExecutor() as pool:
+                    loaded = list(pool.map(hexsegments, options.hexfiles))
+            else:
+                loaded = [hexsegments(options.hexfiles[0])]
+            segments = []
+            for hexsegs in loaded:
+                segments.extend(hexsegs)
+            for address, data in coalesce(segments):
+                target.append({"address": address, "alt": default_alt, "data": data})
             targets.append(target)
 
         outfile = args[0]
@@ -282,50 +320,51 @@ if __name__ == "__main__":
             sys.exit(1)
         build(outfile, targets, DEFAULT_NAME, device)
     elif options.s19files and len(args) == 1:
+        # Hex payloads of contiguous records are collected per run and only
+        # decoded once the run ends
         address = 0
-        data = ""
+        size = 0
+        data = []
         target = []
         name = DEFAULT_NAME
-        with open(options.s19files) as f:
-            lines = f.readlines()
-            for line in lines:
+        with open(options.s19files, "rb") as f:
+            for line in f:
                 curaddress = 0
-                curdata = ""
+                curdata = b""
                 line = line.rstrip()
-                if line.startswith("S0"):
-                    name = binascii.a2b_hex(line[8 : len(line) - 2])
-                elif line.startswith("S3"):
-                    try:
-                        curaddress = int(line[4:12], 16) & 0xFFFFFFFF
-                    except ValueError:
-                        print("Address %s invalid." % address)
-                        sys.exit(1)
-                    curdata = binascii.unhexlify(line[12:-2])
-                elif line.startswith("S2"):
+                rtype = line[:2]
+                width = S19_DATA_RECORDS.get(rtype)
+                if width is not None:
+                    # The byte count covers address, data and checksum
+                    dstart = 4 + 2 * width
                     try:
-                        curaddress = int(line[4:10], 16) & 0xFFFFFFFF
+                        dend = 2 + 2 * int(line[2:4], 16)
+                        curaddress = int(line[4:dstart], 16) & 0xFFFFFFFF
                     except ValueError:
                         print("Address %s invalid." % address)
                         sys.exit(1)
-                    curdata = binascii.unhexlify(line[10:-2])
-                elif line.startswith("S1"):
-                    try:
-                        curaddress = int(line[4:8], 16) & 0xFFFFFFFF
-                    except ValueError:
-                        print("Address %s invalid." % address)
-                        sys.exit(1)
-                    curdata = binascii.unhexlify(line[8:-2])
+                    curdata = line[dstart:dend]
+                elif rtype == b"S0":
+                    dend = 2 + 2 * int(line[2:4], 16)
+                    name = bytes.fromhex(line[8:dend].decode("ascii"))
                 if address == 0:
                     address = curaddress
-                    data = curdata
-                elif address + len(data) != curaddress:
+                    size = len(curdata) // 2
+                    data = [curdata]
+                elif address + size != curaddress:
                     target.append(
-                        {"address": address, "alt": default_alt, "data": data}
+                        {
+                            "address": address,
+                            "alt": default_alt,
+                            "data": bytes.fromhex(b"".join(data).decode("ascii")),
+                        }
                     )
                     address = curaddress
-                    data = curdata
+                    size = len(curdata) // 2
+                    data = [curdata]
                 else:
-                    data += curdata
+                    size += len(curdata) // 2
+                    data.append(curdata)
         outfile = args[0]
         device = DEFAULT_DEVICE
         if options.device: